@@ -456,9 +456,9 @@ class BundleAdjustmentPipeline:
                 args = [self.C, self.pts3d, self.cameras, self.cam_model, self.pairs_to_triangulate, cam_centers]
                 C_reproj = ft_ranking.compute_C_reproj(*args)
             else:
-                C_reproj = np.zeros(C_scale.shape)
+                C_reproj = np.zeros(C_scale.shape, dtype=np.float32)
 
-            true_if_new_track = np.sum(~np.isnan(self.C[::2, :])[-self.n_new :] * 1, axis=0).astype(bool)
+            true_if_new_track = (~np.isnan(self.C[::2, :])[-self.n_new :]).any(axis=0)
             C_new = self.C[:, true_if_new_track]
             C_scale_new = C_scale[:, true_if_new_track]
             C_reproj_new = C_reproj[:, true_if_new_track]
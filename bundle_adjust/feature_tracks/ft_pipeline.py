@@ -172,7 +172,7 @@ class FeatureTracksPipeline:
             C, C_v2 = ft_utils.feature_tracks_from_pairwise_matches(*args)
             # n_pts_fix = amount of columns with no observations in the new cameras to adjust
             # these columns have to be put at the beginning of C
-            where_fix_pts = np.sum(1 * ~np.isnan(C[::2, :])[self.n_adj:], axis=0) == 0
+            where_fix_pts = ~(~np.isnan(C[::2, :])[self.n_adj:]).any(axis=0)
             n_pts_fix = np.sum(1 * where_fix_pts)
             if n_pts_fix > 0:
                 C = np.hstack([C[:, where_fix_pts], C[:, ~where_fix_pts]])
@@ -12,23 +12,49 @@ import numpy as np
 import timeit
 import os
 
+from numba import njit, prange
+
 from bundle_adjust import ba_core
+from bundle_adjust.ba_params import BundleAdjustmentParameters
 from bundle_adjust.loader import flush_print
 
+# number of bits set in each possible byte value, to count visibility bitset intersections
+_POPCOUNT_TABLE = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+@njit(parallel=True, cache=True)
+def covisibility_counts(bits, popcount_table):
+    """
+    Count the pairwise intersections between the rows of a packed visibility mask
+    bits is an array of shape (n_cam)x(n_bytes) where row i contains the visibility bitset of camera i
+    Output A is the symmetric (n_cam)x(n_cam) matrix of co-visible track counts, with a zero diagonal
+    """
+    n_cam, n_bytes = bits.shape
+    A = np.zeros((n_cam, n_cam))
+    for i in prange(n_cam):
+        for j in range(i + 1, n_cam):
+            c = 0
+            for b in range(n_bytes):
+                c += popcount_table[bits[i, b] & bits[j, b]]
+            A[i, j] = c
+            A[j, i] = c
+    return A
+
 
-def build_connectivity_matrix(C, min_matches=10):
+def build_connectivity_matrix(C, min_matches=10, vis=None):
     """
     Compute the connectivity matrix A,
     A is a matrix with size (n_cam)x(n_cam), where n_cam is the number of cameras
     the value at position (i,j) is equal to the amount of pairwise matches found between image i and image j
+    vis is an optional boolean mask of shape (n_cam)x(n_tracks), equivalent to ~np.isnan(C[::2]),
+    which can be precomputed by the caller to avoid scanning C for NaN values multiple times
     """
-    n_cam = C.shape[0] // 2
-    A = np.zeros((n_cam, n_cam))
-    C_not_nan = ~np.isnan(C[::2])
-    for im1 in range(n_cam):
-        for im2 in range(im1 + 1, n_cam):
-            A[im1, im2] = np.sum(C_not_nan[im1, :] & C_not_nan[im2, :])
-            A[im2, im1] = A[im1, im2]
+    if vis is None:
+        vis = ~np.isnan(C[::2])
+    # pack each visibility row into a bitset, 8x smaller than the boolean mask,
+    # and count the pairwise intersections with a compiled kernel parallelized over cameras
+    bits = np.packbits(vis, axis=1)
+    A = covisibility_counts(bits, _POPCOUNT_TABLE)
     A[A < min_matches] = 0
 
     return A
@@ -61,8 +87,6 @@ def compute_C_reproj(C, pts3d, cameras, cam_model, pairs_to_triangulate, camera_
     """
 
     # set ba parameters
-    from bundle_adjust.ba_params import BundleAdjustmentParameters
-
     args = [C, pts3d, cameras, cam_model, pairs_to_triangulate, camera_centers]
     d = {"reduce": False, "verbose": False}
     p = BundleAdjustmentParameters(*args, d)
@@ -71,16 +95,16 @@ def compute_C_reproj(C, pts3d, cameras, cam_model, pairs_to_triangulate, camera_
     reprojection_err_per_obs = ba_core.compute_reprojection_error(ba_core.fun(p.params_opt.copy(), p))
 
     # create C_reproj
+    # float32 is more than enough precision for reprojection errors and halves the memory traffic
+    # of the reductions that the track selection algorithm runs over C_reproj
     n_cam, n_pts = C.shape[0] // 2, C.shape[1]
-    C_reproj = np.zeros((n_cam, n_pts))
-    C_reproj[:] = np.nan
-    for i, err in enumerate(reprojection_err_per_obs):
-        C_reproj[p.cam_ind[i], p.pts_ind[i]] = err
+    C_reproj = np.full((n_cam, n_pts), np.nan, dtype=np.float32)
+    C_reproj[p.cam_ind, p.pts_ind] = reprojection_err_per_obs
 
     return C_reproj
 
 
-def compute_camera_weights(C, C_reproj, connectivity_matrix=None):
+def compute_camera_weights(C, C_reproj, connectivity_matrix=None, vis=None):
     """
     Compute camera weights. Each camera is assigned a float weight W(camera) which depends on 2 factors:
     (1) neighbors(camera), i.e. the number of cameras it is connected to according to the connectivity matrix
@@ -92,30 +116,31 @@ def compute_camera_weights(C, C_reproj, connectivity_matrix=None):
 
     # initialize connectivity matrix
     n_cam, n_tracks = C.shape[0] // 2, C.shape[1]
-    A = build_connectivity_matrix(C, min_matches=0) if connectivity_matrix is None else connectivity_matrix
-    mask = ~np.isnan(C[::2])
+    mask = ~np.isnan(C[::2]) if vis is None else vis
+    A = build_connectivity_matrix(C, min_matches=0, vis=mask) if connectivity_matrix is None else connectivity_matrix
 
-    # compute vector of camera weights
-    w_cam = []
-    for i in range(n_cam):
+    # compute neighbors(camera), for all cameras at once (A holds no negative values)
+    nC = np.count_nonzero(A, axis=1)
 
-        # compute neighbors(camera)
-        nC_i = np.sum(A[i, :] > 0)
+    # compute cost(camera), for all cameras at once
+    # cost(camera) results from the mean/std of the average reprojection error per track seen in the camera
+    # the mean/std per camera are obtained from the per-track sums and sums of squares via two matrix-vector
+    # products; the visibility mask is intrinsically sparse, so a CSR matrix of the observations makes these
+    # products cost O(observations) instead of O(n_cam * n_tracks) and avoids a dense float copy of the mask
+    from scipy.sparse import csr_matrix
 
-        # compute cost(camera)
-        if nC_i > 0:
-            # cost(camera) results from the mean/std of the average reprojection error per track seen in the camera
-            indices_of_tracks_seen_in_current_cam = np.arange(n_tracks)[mask[i]]
-            avg_reproj_err_tracks_seen = np.nanmean(C_reproj[:, indices_of_tracks_seen_in_current_cam], axis=0)
-            avg_cost = np.mean(avg_reproj_err_tracks_seen)
-            std_cost = np.std(avg_reproj_err_tracks_seen)
-            costC_i = avg_cost + 3.0 * std_cost
-        else:
-            costC_i = 0.0
+    track_avg_reproj = np.nanmean(C_reproj, axis=0)
+    track_avg_reproj = np.where(np.isnan(track_avg_reproj), 0.0, track_avg_reproj)
+    Vb = csr_matrix(mask, dtype=np.float64)
+    n_tracks_seen = np.maximum(mask.sum(axis=1), 1)
+    avg_cost = Vb.dot(track_avg_reproj) / n_tracks_seen
+    var_cost = Vb.dot(track_avg_reproj * track_avg_reproj) / n_tracks_seen - avg_cost ** 2
+    std_cost = np.sqrt(np.maximum(var_cost, 0.0))
+    costC = np.where(nC > 0, avg_cost + 3.0 * std_cost, 0.0)
 
-        w_cam.append(float(nC_i) + np.exp(-costC_i))
+    w_cam = nC.astype(float) + np.exp(-costC)
 
-    return w_cam
+    return w_cam.tolist()
 
 
 def print_quick_camera_weights(geotiff_paths, C):
@@ -133,27 +158,37 @@ def print_quick_camera_weights(geotiff_paths, C):
         print("    - cam {:3} - {} - neighbors {} - median obs per neighbor {}".format(i, os.path.basename(geotiff_paths[i]), w_cam[i], obs_cam[i]))
 
 
-def order_tracks(C, C_scale, C_reproj, priority=["length", "scale", "cost"]):
+def order_tracks(C, C_scale, C_reproj, priority=["length", "scale", "cost"], vis=None):
     """
     Compute a ranking of feature tracks, ordered in decreasing priority
     Tracks with highest priority will be selected first
-    Output ranked_track_indices is a dict where
-                                                key = index of track in C
-                                                value = position in track ranking
+    Output ranked_track_indices is an array of n_tracks integers where
+    position i contains the position of the i-th track of C in the ranking
     """
     n_tracks = C.shape[1]
-    tracks_length = (np.sum(~np.isnan(C), axis=0) / 2).astype(np.int32)
+    if vis is None:
+        vis = ~np.isnan(C[::2])
+    tracks_length = vis.sum(axis=0).astype(np.int32)
     tracks_scale = np.round(np.nanmean(C_scale, axis=0), 2).astype(np.float64)
-    tracks_cost = np.nanmean(C_reproj, axis=0).astype(np.float64)
+    # per-track average reprojection error via a masked sum-divide, which avoids nanmean's per-call NaN scans
+    reproj_obs = ~np.isnan(C_reproj)
+    n_reproj_obs = reproj_obs.sum(axis=0)
+    reproj_sum = np.where(reproj_obs, C_reproj, 0.0).sum(axis=0)
+    tracks_cost = np.where(n_reproj_obs > 0, reproj_sum / np.maximum(n_reproj_obs, 1), np.nan)
 
     tracks_dtype = [("length", int), ("scale", float), ("cost", float)]
-    track_values = np.array(list(zip(tracks_length, -tracks_scale, -tracks_cost)), dtype=tracks_dtype)
-    ranked_track_indices = dict(list(zip(np.argsort(track_values, order=priority)[::-1], np.arange(n_tracks))))
+    track_values = np.empty(n_tracks, dtype=tracks_dtype)
+    track_values["length"] = tracks_length
+    track_values["scale"] = -tracks_scale
+    track_values["cost"] = -tracks_cost
+    order = np.argsort(track_values, order=priority)[::-1]
+    ranked_track_indices = np.empty(n_tracks, dtype=np.int64)
+    ranked_track_indices[order] = np.arange(n_tracks)
 
     return ranked_track_indices
 
 
-def get_inverted_track_list(C, ranked_track_indices):
+def get_inverted_track_list(C, ranked_track_indices, vis=None):
     """
     Compute inverted list based on the feature tracks ranking
     The i-th position of the output inverted_track_list contains a list with the indices
@@ -161,75 +196,181 @@ def get_inverted_track_list(C, ranked_track_indices):
     """
     inverted_track_list = []
     n_cam = C.shape[0] // 2
-    mask = ~np.isnan(C[::2])
-    f = lambda idx: ranked_track_indices[idx]
+    mask = ~np.isnan(C[::2]) if vis is None else vis
+    global_order = np.argsort(ranked_track_indices)  # all track indices, from highest to lowest priority
     for i in range(n_cam):
-        indices_of_tracks_seen_in_current_cam = np.where(mask[i])[0]
-        s = sorted(indices_of_tracks_seen_in_current_cam, key=f)
-        inverted_track_list.append(s)
+        inverted_track_list.append(global_order[mask[i, global_order]])
 
     return inverted_track_list
 
 
-def get_cam_indices_per_track(C):
+@njit(cache=True)
+def grow_tree(neighbor_cams, track_cams_ptr, track_cams_idx, tracks_ptr, tracks_idx, cam_weights, root):
     """
-    For each track in the connectivity matrix C, get the indices of the cameras where it is seen
+    Compiled kernel of get_tracks_current_tree
+    The inverted track lists are given in CSR format, i.e. tracks_idx[tracks_ptr[i]:tracks_ptr[i+1]]
+    contains the tracks visible in camera i, from highest to lowest priority
+    The track visibility is given in CSC format, i.e. track_cams_idx[track_cams_ptr[t]:track_cams_ptr[t+1]]
+    contains the indices of the cameras where track t is seen
+    Output in_Sk is a boolean mask, true at the tracks selected for the current tree
     """
-    mask = ~np.isnan(C[::2])
-    cam_indices_per_track = []
-    for track_idx in range(C.shape[1]):
-        s = set(np.where(mask[:, track_idx])[0])
-        cam_indices_per_track.append(s)
-    return cam_indices_per_track
+    n_cam = neighbor_cams.shape[0]
+    n_tracks = track_cams_ptr.shape[0] - 1
+    in_Sk = np.zeros(n_tracks, dtype=np.bool_)  # true at the tracks selected for the current tree
+    in_Ik = np.zeros(n_cam, dtype=np.bool_)  # true at the cameras already connected to the current tree
+    in_Ik[root] = True
+    n_connected = 1  # number of cameras connected to the current tree
+    nodes_last_layer_Hk = np.empty(n_cam, dtype=np.int64)
+    nodes_last_layer_Hk[0] = root
+    n_last = 1
+    nodes_next_layer_Hk = np.empty(n_cam, dtype=np.int64)
+
+    while True:
+        n_next = 0
+        for c in range(n_last):
+            cam_idx = nodes_last_layer_Hk[c]
+            for t in range(tracks_ptr[cam_idx], tracks_ptr[cam_idx + 1]):
+                track_idx = tracks_idx[t]
+                if in_Sk[track_idx]:
+                    continue
 
+                track_connects_new_cams = False
+                for q in range(track_cams_ptr[track_idx], track_cams_ptr[track_idx + 1]):
+                    cam = track_cams_idx[q]
+                    if neighbor_cams[cam_idx, cam] and not in_Ik[cam]:
+                        nodes_next_layer_Hk[n_next] = cam
+                        n_next += 1
+                        in_Ik[cam] = True
+                        n_connected += 1
+                        track_connects_new_cams = True
+                if track_connects_new_cams:
+                    in_Sk[track_idx] = True
+
+        if n_connected == n_cam or n_next == 0:
+            break
+
+        # visit the cameras of the next layer in decreasing weight order
+        order = np.argsort(-cam_weights[nodes_next_layer_Hk[:n_next]], kind="mergesort")
+        for c in range(n_next):
+            nodes_last_layer_Hk[c] = nodes_next_layer_Hk[order[c]]
+        n_last = n_next
+
+    return in_Sk
 
-def get_cam_indices_per_cam(A):
+
+def get_cam_indices_per_track(vis):
     """
-    For each camera, get the indices of the neighbor cameras according to the connectivity matrix A
+    For each track, get the indices of the cameras where it is seen, in CSC format:
+    track_cams_idx[track_cams_ptr[t]:track_cams_ptr[t+1]] contains the camera indices seeing track t
     """
-    cam_indices_per_cam = []
-    for cam_idx in range(A.shape[1]):
-        indices = np.nonzero(A[cam_idx])[0]
-        cam_indices_per_cam.append(set(indices))
-    return cam_indices_per_cam
+    n_tracks = vis.shape[1]
+    nz_cam, nz_track = np.nonzero(vis)
+    order = np.argsort(nz_track, kind="stable")
+    track_cams_idx = nz_cam[order].astype(np.int64)
+    track_cams_ptr = np.zeros(n_tracks + 1, dtype=np.int64)
+    track_cams_ptr[1:] = np.cumsum(np.bincount(nz_track, minlength=n_tracks))
+    return track_cams_ptr, track_cams_idx
 
 
-def get_tracks_current_tree(A, V, cam_weights, cam_indices_per_track, inverted_track_list):
+@njit(cache=True)
+def _popcount64(x):
     """
-    Constructs one spanning tree, that connects as much cameras as possible using the tracks with highest priority
-    Output Sk is the group of tracks used to construct the tree
+    Number of bits set in a uint64 value, computed branchlessly
     """
-    cam_indices_per_cam = get_cam_indices_per_cam(A)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
 
-    Croot = np.argmax(cam_weights)
-    nodes_last_layer_Hk = [Croot]
-    Sk = set()
-    Ik = set(nodes_last_layer_Hk)
+@njit(cache=True)
+def grow_tree_bits(neighbor_cams, track_cams_ptr, track_cams_idx, tracks_ptr, tracks_idx, cam_weights, root):
+    """
+    Variant of grow_tree specialized for scenes with up to 64 cameras
+    Every camera subset (cameras seeing a track, neighbors of a camera, cameras connected to the tree)
+    fits in a single uint64 bitmask, so the per-track update reduces to a couple of machine instructions
+    """
+    n_cam = neighbor_cams.shape[0]
+    n_tracks = track_cams_ptr.shape[0] - 1
+    one = np.uint64(1)
+    zero = np.uint64(0)
+
+    # pack the cameras seeing each track and the neighbors of each camera into uint64 bitmasks
+    track_bits = np.zeros(n_tracks, dtype=np.uint64)
+    for t in range(n_tracks):
+        b = zero
+        for q in range(track_cams_ptr[t], track_cams_ptr[t + 1]):
+            b |= one << np.uint64(track_cams_idx[q])
+        track_bits[t] = b
+    neighbor_bits = np.zeros(n_cam, dtype=np.uint64)
+    for i in range(n_cam):
+        b = zero
+        for j in range(n_cam):
+            if neighbor_cams[i, j]:
+                b |= one << np.uint64(j)
+        neighbor_bits[i] = b
+
+    in_Sk = np.zeros(n_tracks, dtype=np.bool_)  # true at the tracks selected for the current tree
+    ik_bits = one << np.uint64(root)  # bitmask of the cameras already connected to the current tree
+    n_connected = 1
+    nodes_last_layer_Hk = np.empty(n_cam, dtype=np.int64)
+    nodes_last_layer_Hk[0] = root
+    n_last = 1
+    nodes_next_layer_Hk = np.empty(n_cam, dtype=np.int64)
 
     while True:
-        nodes_next_layer_Hk = []
-        for cam_idx in nodes_last_layer_Hk:
-            for track_idx in inverted_track_list[cam_idx]:
-                if track_idx in Sk:
+        n_next = 0
+        for c in range(n_last):
+            cam_idx = nodes_last_layer_Hk[c]
+            rq_bits = neighbor_bits[cam_idx]
+            for t in range(tracks_ptr[cam_idx], tracks_ptr[cam_idx + 1]):
+                track_idx = tracks_idx[t]
+                if in_Sk[track_idx]:
                     continue
 
-                Wq = cam_indices_per_track[track_idx]
-                Rq = cam_indices_per_cam[cam_idx]
-                not_done = (Wq & Rq) - Ik
-                if len(not_done) > 0:
-                    nodes_next_layer_Hk.extend(not_done)
-                    Sk.add(track_idx)
-                    Ik |= not_done
-
-        if len(V - Ik) == 0 or len(nodes_next_layer_Hk) == 0:
+                not_done = track_bits[track_idx] & rq_bits & ~ik_bits
+                if not_done != zero:
+                    in_Sk[track_idx] = True
+                    ik_bits |= not_done
+                    while not_done != zero:  # visit the new cameras in ascending index order
+                        lowest_bit = not_done & (zero - not_done)
+                        nodes_next_layer_Hk[n_next] = np.int64(_popcount64(lowest_bit - one))
+                        n_next += 1
+                        n_connected += 1
+                        not_done ^= lowest_bit
+
+        if n_connected == n_cam or n_next == 0:
             break
 
-        nodes_last_layer_Hk = sorted(nodes_next_layer_Hk, key=lambda a: -cam_weights[a])
+        # visit the cameras of the next layer in decreasing weight order
+        order = np.argsort(-cam_weights[nodes_next_layer_Hk[:n_next]], kind="mergesort")
+        for c in range(n_next):
+            nodes_last_layer_Hk[c] = nodes_next_layer_Hk[order[c]]
+        n_last = n_next
 
-    return Sk
+    return in_Sk
 
 
-def get_tracks(C, C_reproj, K, ranked_track_indices):
+def get_tracks_current_tree(A, cam_weights, track_cams_ptr, track_cams_idx, inverted_track_list):
+    """
+    Constructs one spanning tree, that connects as much cameras as possible using the tracks with highest priority
+    track_cams_ptr and track_cams_idx encode the cameras seeing each track, see get_cam_indices_per_track
+    Output Sk is the group of tracks used to construct the tree
+    """
+    Croot = int(np.argmax(cam_weights))
+    tracks_ptr = np.zeros(len(inverted_track_list) + 1, dtype=np.int64)
+    for i, tracks in enumerate(inverted_track_list):
+        tracks_ptr[i + 1] = tracks_ptr[i] + len(tracks)
+    tracks_idx = np.concatenate(inverted_track_list).astype(np.int64)
+
+    cam_weights = np.asarray(cam_weights, dtype=np.float64)
+    args = [A > 0, track_cams_ptr, track_cams_idx, tracks_ptr, tracks_idx, cam_weights, Croot]
+    in_Sk = grow_tree_bits(*args) if A.shape[0] <= 64 else grow_tree(*args)
+
+    return np.flatnonzero(in_Sk)
+
+
+def get_tracks(C, C_reproj, K, ranked_track_indices, vis=None):
     """
     Runs the feature track selection
     Outputs an optimal subset S of feature tracks extracted from an input correspondence matrix C
@@ -238,27 +379,31 @@ def get_tracks(C, C_reproj, K, ranked_track_indices):
     cameras with highest weight are visited first, and for each camera, tracks with highest priority are visited first
     Each spanning tree selects some tracks, which are expected to connect as much cameras as possible
     """
-    n_cam = C.shape[0] // 2
-    remaining_T = set(np.arange(C.shape[1]))
-    T = set(np.arange(C.shape[1]))  # all track indices
-    V = set(np.arange(n_cam))  # all camera indices
+    n_cam, n_tracks = C.shape[0] // 2, C.shape[1]
 
     k = 0  # current spanning tree index
     S = []  # indices of the selected feature tracks (= indices of columns of C that are selected)
-    cam_indices_per_track = get_cam_indices_per_track(C)
-    updated_C = C.copy()
-    while k < K and len(S) < len(T):
-
-        # update connectivity matrix, inverted track list and camera weights with the new correspondence matrix C
-        A = build_connectivity_matrix(updated_C, min_matches=0)
-        inverted_track_list = get_inverted_track_list(updated_C, ranked_track_indices)
-        cam_weights = np.array(compute_camera_weights(updated_C, C_reproj, connectivity_matrix=A))
-
-        Sk = get_tracks_current_tree(A, V, cam_weights, cam_indices_per_track, inverted_track_list)
+    if vis is None:
+        vis = ~np.isnan(C[::2])  # visibility mask, updated as tracks are selected
+    # the cameras where each track is seen, according to the original C, in CSC format
+    track_cams_ptr, track_cams_idx = get_cam_indices_per_track(vis)
+    A = build_connectivity_matrix(C, min_matches=0, vis=vis)
+    while k < K and len(S) < n_tracks:
+
+        # update inverted track list and camera weights with the current visibility mask
+        inverted_track_list = get_inverted_track_list(C, ranked_track_indices, vis=vis)
+        cam_weights = np.array(compute_camera_weights(C, C_reproj, connectivity_matrix=A, vis=vis))
+
+        Sk = get_tracks_current_tree(A, cam_weights, track_cams_ptr, track_cams_idx, inverted_track_list)
         k += 1
-        remaining_T -= Sk
         S.extend(Sk)
-        updated_C[:, list(Sk)] = np.nan
+
+        # removing the selected tracks only changes the pairwise match counts involving their columns,
+        # so the connectivity matrix is corrected with a low-rank update instead of rebuilt from scratch
+        M_sel = vis[:, Sk].astype(np.int32)
+        A -= M_sel @ M_sel.T
+        np.fill_diagonal(A, 0)
+        vis[:, Sk] = False
 
     return S
 
@@ -273,8 +418,9 @@ def select_best_tracks(C, C_scale, C_reproj, K=30, priority=["length", "scale",
     if verbose:
         flush_print("\nRunning feature tracks selection algorithm...")
 
-    ranked_track_indices = order_tracks(C, C_scale, C_reproj, priority=priority)
-    S = get_tracks(C, C_reproj, K, ranked_track_indices)
+    vis = ~np.isnan(C[::2])
+    ranked_track_indices = order_tracks(C, C_scale, C_reproj, priority=priority, vis=vis)
+    S = get_tracks(C, C_reproj, K, ranked_track_indices, vis=vis)
 
     if verbose:
         flush_print("...done in {:.2f} seconds".format(timeit.default_timer() - t0))
@@ -454,7 +454,7 @@ def load_tracks_from_predefined_matches(input_dir, output_dir, local_data, track
     C, C_v2 = feature_tracks_from_pairwise_matches(feature_paths, matches, pairs_to_triangulate)
     # n_pts_fix = amount of columns with no observations in the new cameras to adjust
     # these columns have to be put at the beginning of C
-    where_fix_pts = np.sum(1 * ~np.isnan(C[::2, :])[local_data["n_adj"] :], axis=0) == 0
+    where_fix_pts = ~(~np.isnan(C[::2, :])[local_data["n_adj"] :]).any(axis=0)
     n_pts_fix = np.sum(1 * where_fix_pts)
     if n_pts_fix > 0:
         C = np.hstack([C[:, where_fix_pts], C[:, ~where_fix_pts]])
@@ -510,23 +510,16 @@ def build_connectivity_graph(C, min_matches, verbose=True):
 
     # (1) Build connectivity matrix A, where position (i,j) contains the number of matches between images i and j
     n_cam = C.shape[0] // 2
-    A, n_correspondences_filt, tmp_pairs = np.zeros((n_cam, n_cam)), [], []
-    not_nan_C = ~np.isnan(C)
-    for im1 in range(n_cam):
-        for im2 in range(im1 + 1, n_cam):
-            n_matches = np.sum(not_nan_C[2 * im1] & not_nan_C[2 * im2])
-            n_correspondences_filt.append(n_matches)
-            tmp_pairs.append((im1, im2))
-            A[im1, im2] = n_matches
-            A[im2, im1] = n_matches
+    M = (~np.isnan(C[::2])).astype(np.int32)
+    A = (M @ M.T).astype(float)
+    np.fill_diagonal(A, 0)
 
     # (2) Filter graph edges according to the threshold on the number of matches
-    edges = []
-    matches_per_edge = []
-    for i in range(len(tmp_pairs)):
-        if n_correspondences_filt[i] > min_matches:
-            edges.append(tmp_pairs[i])
-            matches_per_edge.append(n_correspondences_filt[i])
+    im1_arr, im2_arr = np.triu_indices(n_cam, k=1)
+    n_correspondences_filt = A[im1_arr, im2_arr].astype(int)
+    edges_ok = n_correspondences_filt > min_matches
+    edges = list(zip(im1_arr[edges_ok].tolist(), im2_arr[edges_ok].tolist()))
+    matches_per_edge = n_correspondences_filt[edges_ok].tolist()
 
     # (3) Create networkx graph
     G = nx.Graph()
@@ -1,5 +1,6 @@
 import numpy as np
 
+from bundle_adjust.feature_tracks.ft_ranking import select_best_tracks
 from bundle_adjust.ba_rotate import (
     R_to_quaternion,
     euler_angles_from_R,
@@ -61,3 +62,110 @@ def test_ba_rotate():
     # conversion between quaternion and rotation matrix failed
     assert np.allclose(R, quaternion_to_R(*R_to_quaternion(R)))
     # conversion between axis-angle and rotation matrix failed
+
+
+def synthetic_correspondence_matrices(seed, n_cam, n_tracks):
+    # random C, C_scale, C_reproj matrices where each track is seen by 2 to 5 cameras
+    rng = np.random.default_rng(seed)
+    C = np.full((2 * n_cam, n_tracks), np.nan)
+    C_scale = np.full((n_cam, n_tracks), np.nan)
+    C_reproj = np.full((n_cam, n_tracks), np.nan)
+    for t in range(n_tracks):
+        cams = rng.choice(n_cam, size=rng.integers(2, 6), replace=False)
+        for c in cams:
+            C[2 * c, t] = rng.uniform(0, 1000)
+            C[2 * c + 1, t] = rng.uniform(0, 1000)
+            C_scale[c, t] = rng.uniform(1, 4)
+            C_reproj[c, t] = rng.uniform(0, 2)
+    return C, C_scale, C_reproj
+
+
+def reference_track_selection(C, C_scale, C_reproj, K):
+    # straightforward set-based implementation of the track selection algorithm, kept as ground
+    # truth for the compiled kernels and the incremental connectivity update of ft_ranking
+    n_cam, n_tracks = C.shape[0] // 2, C.shape[1]
+    vis = ~np.isnan(C[::2])
+
+    # rank all tracks by decreasing (length, scale, cost) priority
+    track_values = np.empty(n_tracks, dtype=[("length", int), ("scale", float), ("cost", float)])
+    track_values["length"] = vis.sum(axis=0)
+    track_values["scale"] = -np.round(np.nanmean(C_scale, axis=0), 2)
+    track_values["cost"] = -np.nanmean(C_reproj, axis=0)
+    rank = np.empty(n_tracks, dtype=int)
+    rank[np.argsort(track_values, order=["length", "scale", "cost"])[::-1]] = np.arange(n_tracks)
+
+    track_avg_reproj = np.nanmean(C_reproj, axis=0)
+    track_avg_reproj = np.where(np.isnan(track_avg_reproj), 0.0, track_avg_reproj)
+    cams_per_track = [set(np.flatnonzero(vis[:, t])) for t in range(n_tracks)]
+
+    remaining = vis.copy()
+    S = []
+    for _ in range(K):
+        if len(S) >= n_tracks:
+            break
+
+        # connectivity matrix and camera weights from the tracks that are still selectable
+        A = np.zeros((n_cam, n_cam))
+        for i in range(n_cam):
+            for j in range(i + 1, n_cam):
+                A[i, j] = A[j, i] = np.sum(remaining[i] & remaining[j])
+        w = []
+        for i in range(n_cam):
+            n_neighbors = np.sum(A[i] > 0)
+            if n_neighbors > 0:
+                seen = track_avg_reproj[remaining[i]]
+                cost = np.mean(seen) + 3.0 * np.std(seen)
+            else:
+                cost = 0.0
+            w.append(float(n_neighbors) + np.exp(-cost))
+
+        # grow one spanning tree from the heaviest camera
+        root = int(np.argmax(w))
+        connected = {root}
+        layer = [root]
+        selected = set()
+        while True:
+            next_layer = []
+            for cam in layer:
+                for t in sorted(np.flatnonzero(remaining[cam]), key=lambda t: rank[t]):
+                    if t in selected:
+                        continue
+                    new_cams = sorted((cams_per_track[t] & set(np.flatnonzero(A[cam] > 0))) - connected)
+                    if new_cams:
+                        selected.add(t)
+                        connected.update(new_cams)
+                        next_layer.extend(new_cams)
+            if len(connected) == n_cam or len(next_layer) == 0:
+                break
+            layer = sorted(next_layer, key=lambda c: -w[c])
+
+        Sk = sorted(selected)
+        S.extend(Sk)
+        remaining[:, Sk] = False
+
+    return S
+
+
+def test_select_best_tracks():
+    # bitmask kernel (n_cam <= 64), boundary case, and CSC kernel (n_cam > 64)
+    for seed, n_cam, n_tracks, K in [(0, 12, 300, 6), (1, 64, 400, 4), (2, 70, 400, 4)]:
+        C, C_scale, C_reproj = synthetic_correspondence_matrices(seed, n_cam, n_tracks)
+        S = select_best_tracks(C, C_scale, C_reproj, K=K)
+        # track selection diverged from the reference implementation
+        assert np.array_equal(S, reference_track_selection(C, C_scale, C_reproj, K))
+
+    # a camera without observations must not break the selection
+    C, C_scale, C_reproj = synthetic_correspondence_matrices(3, 12, 300)
+    C[10:12] = np.nan
+    C_scale[5] = np.nan
+    C_reproj[5] = np.nan
+    S = select_best_tracks(C, C_scale, C_reproj, K=4)
+    # track selection diverged from the reference implementation with an isolated camera
+    assert np.array_equal(S, reference_track_selection(C, C_scale, C_reproj, 4))
+
+    # zero reprojection errors, as used by the pipeline when no 3d points are available
+    C, C_scale, _ = synthetic_correspondence_matrices(4, 12, 300)
+    C_reproj = np.zeros(C_scale.shape, dtype=np.float32)
+    S = select_best_tracks(C, C_scale, C_reproj, K=4)
+    # track selection diverged from the reference implementation with zero reprojection errors
+    assert np.array_equal(S, reference_track_selection(C, C_scale, C_reproj, 4))